@@ -2,27 +2,18 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 import time
+import warnings
 
-import scipy.signal
 import gymnasium as gym
 from gym.spaces import Box, Discrete
 
 import torch
 from torch.optim import Adam
 import torch.nn as nn
+import torch.nn.functional as F
 from torch.distributions.categorical import Categorical
 
 
-def discount_cumsum(x, discount):
-    """
-    Compute  cumulative sums of vectors.
-
-    Input: [x0, x1, ..., xn]
-    Output: [x0 + discount * x1 + discount^2 * x2 + ... , x1 + discount * x2 + ... , ... , xn]
-    """
-    return scipy.signal.lfilter([1], [1, float(-discount)], x[::-1], axis=0)[::-1]
-
-
 def combined_shape(length, shape=None):
     """Helper function that combines two array shapes."""
     if shape is None:
@@ -30,13 +21,39 @@ def combined_shape(length, shape=None):
     return (length, shape) if np.isscalar(shape) else (length, *shape)
 
 
+class FusedMLP(nn.Sequential):
+    """
+    nn.Sequential of alternating Linear and activation layers whose forward pass
+    runs one torch.addmm per layer instead of traversing the submodules.
+    """
+
+    def forward(self, x):
+        # Pair the registered modules on every call, so slicing, append/insert and item
+        # assignment behave as for nn.Sequential, and replaced parameters take effect.
+        # Tanh is applied in place, Identity is skipped and any other activation module
+        # is called as usual.
+        if len(self) % 2:
+            raise ValueError(f"FusedMLP needs Linear/activation pairs, got {len(self)} modules")
+        single = x.dim() == 1
+        if single:
+            x = x.unsqueeze(0)
+        it = iter(self)
+        for lin, act in zip(it, it):
+            x = torch.addmm(lin.bias, x, lin.weight.t())
+            if isinstance(act, nn.Tanh):
+                x = x.tanh_()
+            elif not isinstance(act, nn.Identity):
+                x = act(x)
+        return x.squeeze(0) if single else x
+
+
 def mlp(sizes, activation, output_activation=nn.Identity):
     """The basic multilayer perceptron architecture used."""
     layers = []
     for j in range(len(sizes) - 1):
         act = activation if j < len(sizes) - 2 else output_activation
         layers += [nn.Linear(sizes[j], sizes[j + 1]), act()]
-    return nn.Sequential(*layers)
+    return FusedMLP(*layers)
 
 
 class MLPCategoricalActor(nn.Module):
@@ -45,6 +62,25 @@ class MLPCategoricalActor(nn.Module):
     def __init__(self, obs_dim, act_dim, hidden_sizes, activation):
         super().__init__()
         self.logits_net = mlp([obs_dim] + list(hidden_sizes) + [act_dim], activation)
+        # Route _sample_and_logp through torch.distributions.Categorical, e.g. to check
+        # the direct softmax path against it
+        self.use_distribution = False
+
+    def _sample_and_logp(self, logits, act=None):
+        """
+        Takes logits and returns an action (sampled if act is None) together with its
+        log-probability, without building a distribution object.
+        """
+        if self.use_distribution:
+            pi = Categorical(logits=logits)
+            if act is None:
+                act = pi.sample()
+            return act, pi.log_prob(act)
+        logp_all = F.log_softmax(logits, -1)
+        if act is None:
+            act = torch.multinomial(logp_all.exp(), 1).squeeze(-1)
+        logp = logp_all.gather(-1, act.long().unsqueeze(-1)).squeeze(-1)
+        return act, logp
 
     def _distribution(self, obs):
         """Takes the observation and outputs a distribution over actions."""
@@ -97,10 +133,41 @@ class MLPActorCritic(nn.Module):
         # Build value function
         self.v = MLPCritic(obs_dim, hidden_sizes, activation)
 
+    def try_compile(self, example_obs):
+        """
+        Compile both networks with torch.compile, keeping them eager if compilation
+        fails on example_obs (e.g. no working Inductor toolchain on this machine).
+        Returns whether the networks are compiled.
+        """
+        # Each network sees only a few input shapes: logits_net gets rollout batches,
+        # single observations from act_only and the full buffer in pi_update; v_net gets
+        # rollout batches and the value-update minibatch sizes. With static shapes each
+        # of these is compiled once, and Inductor fuses the activations.
+        # Module.compile works in place, so the state_dict keys stay unchanged.
+        nets = self.pi.logits_net, self.v.v_net
+        for net in nets:
+            net.compile(mode="reduce-overhead", dynamic=False)
+        # Probe both the inference graphs used in the rollout and the training graphs
+        # (forward and backward) used by the updates.
+        try:
+            with torch.inference_mode():
+                for net in nets:
+                    net(example_obs)
+            sum(net(example_obs).sum() for net in nets).backward()
+        except Exception as e:
+            warnings.warn(f"torch.compile failed, running the networks eagerly: {e}")
+            for net in nets:
+                net._compiled_call_impl = None
+            return False
+        finally:
+            for p in self.parameters():
+                p.grad = None
+        return True
+
     def step(self, state):
         """
-        Take a state and return an action, value function, and log-likelihood
-        of chosen action.
+        Take a batch of states and return the sampled actions, value function, and
+        log-likelihoods of the chosen actions, each as a tensor with one entry per state.
         """
         # TODO1: Implement this function.
         # It is supposed to return three numbers:
@@ -109,102 +176,184 @@ class MLPActorCritic(nn.Module):
         #    3. The log-probability of the action under the policy output distribution
         # Hint: This function is only called when interacting with the environment. You should use
         # `torch.no_grad` to ensure that it does not interfere with the gradient computation.
-        with torch.no_grad():
-            distr, log_prob = self.pi(state)
-            act = distr.sample()
-            value_at_state = self.v(state)
-            dist2, log_prob = self.pi.forward(state, act)
-            act = distr.sample().item()
-        return act, value_at_state, log_prob
+        # inference_mode additionally skips version-counter bookkeeping. A single policy
+        # forward pass and a single sample, so logp belongs to the returned action.
+        with torch.inference_mode():
+            act, logp = self.pi._sample_and_logp(self.pi.logits_net(state))
+            v = self.v(state)
+        return act, v, logp
 
 
 class VPGBuffer:
     """
-    Buffer to store trajectories.
+    Buffer to store trajectories of a vectorised environment. Every sub-environment
+    owns a row of `size` steps which is filled independently of the others.
     """
 
-    def __init__(self, obs_dim, act_dim, size, gamma, lam):
-        self.obs_buf = np.zeros(combined_shape(size, obs_dim), dtype=np.float32)
-        self.act_buf = np.zeros(combined_shape(size, act_dim), dtype=np.float32)
+    def __init__(self, obs_dim, act_dim, num_envs, size, gamma, lam, device="cpu"):
+        # Storage is allocated as torch tensors on the networks' device so get() can
+        # hand them out without any conversion or transfer.
+        self.device = torch.device(device)
+        self.obs_buf = torch.zeros(combined_shape(num_envs, combined_shape(size, obs_dim)),
+                                   dtype=torch.float32, device=self.device)
+        self.act_buf = torch.zeros(combined_shape(num_envs, combined_shape(size, act_dim)),
+                                   dtype=torch.float32, device=self.device)
         # advantage estimates
-        self.phi_buf = np.zeros(size, dtype=np.float32)
+        self.phi_buf = torch.zeros((num_envs, size), dtype=torch.float32, device=self.device)
         # rewards
-        self.rew_buf = np.zeros(size, dtype=np.float32)
+        self.rew_buf = torch.zeros((num_envs, size), dtype=torch.float32, device=self.device)
         # trajectory's remaining return
-        self.ret_buf = np.zeros(size, dtype=np.float32)
+        self.ret_buf = torch.zeros((num_envs, size), dtype=torch.float32, device=self.device)
         # values predicted
-        self.val_buf = np.zeros(size, dtype=np.float32)
+        self.val_buf = torch.zeros((num_envs, size), dtype=torch.float32, device=self.device)
         # log probabilities of chosen actions under behavior policy
-        self.logp_buf = np.zeros(size, dtype=np.float32)
+        self.logp_buf = torch.zeros((num_envs, size), dtype=torch.float32, device=self.device)
+        # Flat views with one row per stored step. Row env * size + t holds step t of
+        # sub-environment env, so store() can write all of them with one index_copy_.
+        self._rows = {k: getattr(self, k + '_buf').flatten(0, 1)
+                      for k in ('obs', 'act', 'phi', 'rew', 'ret', 'val', 'logp')}
         self.gamma = gamma
         self.lam = lam
-        self.ptr, self.path_start_idx, self.max_size = 0, 0, size
-
-    def store(self, obs, act, rew, val, logp):
+        # write position and start of the current trajectory, per sub-environment
+        self.ptr = np.zeros(num_envs, dtype=np.int64)
+        self.path_start_idx = np.zeros(num_envs, dtype=np.int64)
+        self.max_size = size
+        # Per-trajectory work is done in preallocated scratch space: the discount weights
+        # gamma^k and (gamma*lam)^k, the reversing index, and two scratch vectors
+        # (deltas and a temporary) long enough for any trajectory that fits in a row.
+        steps = torch.arange(size, dtype=torch.float32, device=self.device)
+        self._ret_w = gamma ** steps
+        self._phi_w = (gamma * lam) ** steps
+        self._rev_idx = torch.arange(size - 1, -1, -1, device=self.device)
+        self._delta_scratch = torch.empty(size + 1, dtype=torch.float32, device=self.device)
+        self._tmp_scratch = torch.empty(size + 1, dtype=torch.float32, device=self.device)
+        # On GPU, store() stages the selected sub-environments, their destination rows
+        # and the rewards through pinned host memory so the copies are asynchronous. The
+        # event marks when the last copies have read the staging buffers.
+        pin = self.device.type == "cuda"
+        self._idx_host = torch.empty((2, num_envs), dtype=torch.int64, pin_memory=pin)
+        self._rew_host = torch.empty(num_envs, dtype=torch.float32, pin_memory=pin)
+        self._idx_dev = torch.empty((2, num_envs), dtype=torch.int64, device=self.device)
+        self._rew_dev = torch.empty(num_envs, dtype=torch.float32, device=self.device)
+        self._staged = torch.cuda.Event() if pin else None
+
+    def has_room(self):
+        """Boolean mask of the sub-environments whose row is not full yet."""
+        return self.ptr < self.max_size
+
+    def store(self, obs, act, rew, val, logp, mask):
         """
-        Append a single timestep to the buffer. This is called at each environment
-        update to store the outcome observed.
+        Append a single timestep for every sub-environment selected by the boolean
+        `mask`. This is called at each environment update to store the outcome observed.
         """
+        envs = np.flatnonzero(mask)
         # buffer has to have room so you can store
-        assert self.ptr < self.max_size
-        self.obs_buf[self.ptr] = obs
-        self.act_buf[self.ptr] = act
-        self.rew_buf[self.ptr] = rew
-        self.val_buf[self.ptr] = val
-        self.logp_buf[self.ptr] = logp
-        self.ptr += 1
-
-    def end_traj(self, last_val=0):
+        assert (self.ptr[envs] < self.max_size).all()
+        rows = envs * self.max_size + self.ptr[envs]
+        if self._staged is None:
+            sel, rows = torch.from_numpy(envs), torch.from_numpy(rows)
+            rew = torch.as_tensor(rew[envs], dtype=torch.float32)
+        else:
+            # don't overwrite the staging buffers before the previous copies have read them
+            self._staged.synchronize()
+            k = len(envs)
+            idx_host = self._idx_host.numpy()
+            idx_host[0, :k], idx_host[1, :k] = envs, rows
+            self._rew_host.numpy()[:k] = rew[envs]
+            self._idx_dev.copy_(self._idx_host, non_blocking=True)
+            self._rew_dev.copy_(self._rew_host, non_blocking=True)
+            self._staged.record()
+            sel, rows, rew = self._idx_dev[0, :k], self._idx_dev[1, :k], self._rew_dev[:k]
+        self._rows['obs'].index_copy_(0, rows, obs[sel])
+        self._rows['act'].index_copy_(0, rows, act[sel].to(torch.float32))
+        self._rows['rew'].index_copy_(0, rows, rew)
+        self._rows['val'].index_copy_(0, rows, val[sel])
+        self._rows['logp'].index_copy_(0, rows, logp[sel])
+        self.ptr[envs] += 1
+
+    def end_traj(self, env, last_val=0):
         """
-        Call after a trajectory ends. Last value is value(state) if cut-off at a
-        certain state, or 0 if trajectory ended uninterrupted
+        Call after a trajectory of sub-environment `env` ends. Last value is value(state)
+        if cut-off at a certain state, or 0 if trajectory ended uninterrupted
         """
-        path_slice = slice(self.path_start_idx, self.ptr)
-        rews = np.append(self.rew_buf[path_slice], last_val)
-        vals = np.append(self.val_buf[path_slice], last_val)
-
         # TODO6: Implement computation of phi.
 
         # Hint: For estimating the advantage function to use as phi, equation 
         # 16 in the GAE paper (see task description) will be helpful, and so will
-        # the discout_cumsum function at the top of this file. 
-
-        deltas = rews[:-1] + self.gamma*vals[1:] - vals[:-1] #above equ 10
-        discount = self.gamma * self.lam
-        self.phi_buf[path_slice] = discount_cumsum(deltas, discount)
+        # the _discount_cumsum_into method below.
 
         # TODO4: currently the return is the total discounted reward for the whole episode.
         # Replace this by computing the reward-to-go for each timepoint.
-        # Hint: use the discount_cumsum function.
+        # Hint: use the _discount_cumsum_into method.
+
+        # Everything stays on the buffer's device; last_val may be a device tensor too.
+        path_slice = slice(self.path_start_idx[env], self.ptr[env])
+        n = self.ptr[env] - self.path_start_idx[env]
+        rews = self.rew_buf[env, path_slice]
+        vals = self.val_buf[env, path_slice]
 
-        self.ret_buf[path_slice] = discount_cumsum(rews[:-1], self.gamma)
+        # deltas = rews + gamma * next_vals - vals (above equ 10), built in scratch space
+        deltas = self._delta_scratch[:n]
+        deltas[:-1] = vals[1:]
+        deltas[-1] = last_val
+        deltas.mul_(self.gamma).add_(rews).sub_(vals)
+        self._discount_cumsum_into(deltas, self._phi_w, self.phi_buf[env, path_slice])
+        self._discount_cumsum_into(rews, self._ret_w, self.ret_buf[env, path_slice])
+
+        self.path_start_idx[env] = self.ptr[env]
+
+    def _discount_cumsum_into(self, x, w, out):
+        """
+        Compute  cumulative sums of vectors into out.
 
-        self.path_start_idx = self.ptr
+        Input: [x0, x1, ..., xn]
+        Output: [x0 + discount * x1 + discount^2 * x2 + ... , x1 + discount * x2 + ... , ... , xn]
+
+        w holds the precomputed weights discount^k. Works in the scratch vectors instead
+        of allocating and clobbers the delta scratch.
+        """
+        # y[i] = sum_k discount^(k-i) x[k] = (sum_{k>=i} w[k] x[k]) / w[i], i.e. a reversed
+        # cumsum, so it runs on whatever device the buffer lives on. w underflows in float32
+        # only for trajectories of thousands of steps, far above max_ep_len.
+        n = x.shape[0]
+        rev = self._rev_idx[self.max_size - n:]
+        tmp, flipped = self._tmp_scratch[:n], self._delta_scratch[:n]
+        torch.mul(x, w[:n], out=tmp)
+        torch.index_select(tmp, 0, rev, out=flipped)
+        torch.cumsum(flipped, 0, out=tmp)
+        torch.index_select(tmp, 0, rev, out=out)
+        out.div_(w[:n])
 
     def get(self):
         """
         Call after an epoch ends. Resets pointers and returns the buffer contents.
         """
         # Buffer has to be full before you can get something from it.
-        assert self.ptr == self.max_size
-        self.ptr, self.path_start_idx = 0, 0
+        assert (self.ptr == self.max_size).all()
+        self.ptr[:], self.path_start_idx[:] = 0, 0
 
         # TODO7: Here it may help to normalize the values in self.phi_buf
-        mean = np.mean(self.phi_buf)
-        std = np.std(self.phi_buf)
-        self.phi_buf = [(x-mean)/std for x in self.phi_buf] #np.normalise returns np array so better just do it by hand
-        data = dict(obs=self.obs_buf, act=self.act_buf, ret=self.ret_buf,
-                    phi=self.phi_buf, logp=self.logp_buf)
-        return {k: torch.as_tensor(v, dtype=torch.float32) for k, v in data.items()}
+        mean = self.phi_buf.mean()
+        std = self.phi_buf.std(unbiased=False)
+        # normalise in place so the flat views returned below stay valid
+        self.phi_buf.sub_(mean).div_(std + 1e-8)
+        return {k: self._rows[k] for k in ('obs', 'act', 'ret', 'phi', 'logp')}
 
 
 class Agent:
-    def __init__(self, env):
+    def __init__(self, env, compile=None):
         self.env = env
         self.hid = 64  # layer width of networks
         self.l = 2  # layer number of networks
+        # networks and rollout buffer live on the GPU when there is one
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         # initialises an actor critic
-        self.ac = MLPActorCritic(hidden_sizes=[self.hid] * self.l)
+        self.ac = MLPActorCritic(hidden_sizes=[self.hid] * self.l).to(self.device)
+        # compile the networks with torch.compile (falls back to eager if that fails).
+        # By default only on GPU: on CPU compiling costs tens of seconds and gains nothing.
+        if compile is None:
+            compile = self.device.type == "cuda"
+        self.compile = compile and self.ac.try_compile(torch.zeros(8, device=self.device))
 
         # Learning rates for policy and value function
         pi_lr = 3e-3
@@ -214,6 +363,19 @@ class Agent:
         self.pi_optimizer = Adam(self.ac.pi.parameters(), lr=pi_lr)
         self.v_optimizer = Adam(self.ac.v.parameters(), lr=vf_lr)
 
+        # Value function updates per epoch: passes over the buffer and minibatch size
+        self.v_epochs = 5
+        self.v_batch_size = 512
+
+        # Set to e.g. 0.2 to use the PPO clipped objective against the log-probabilities
+        # stored during the rollout instead of the plain policy gradient. The clipped
+        # objective takes up to train_pi_iters steps per epoch, stopping early once the
+        # approximate KL to the behavior policy exceeds 1.5 * target_kl; the plain policy
+        # gradient always takes a single step.
+        self.clip_ratio = None
+        self.train_pi_iters = 80
+        self.target_kl = 0.01
+
     def pi_update(self, data):
         """
         Use the data from the buffer to update the policy. Returns nothing.
@@ -224,18 +386,31 @@ class Agent:
         act = data['act']  # action
         phi = data['phi']  # log_prob
         ret = data['ret']  # reward
-
-        # Before doing any computation, always call.zero_grad on the relevant optimizer
-        self.pi_optimizer.zero_grad()
+        logp_old = data['logp']  # log_prob under the behavior policy
 
         # Hint: you need to compute a 'loss' such that its derivative with respect to the policy
         # parameters is the policy gradient. Then call loss.backwards() and pi_optimizer.step()
-        dist, log_pb = self.ac.pi.forward(obs, act=act)
-        g = phi*log_pb
-        loss = -g.mean()
+        n_iters = 1 if self.clip_ratio is None else self.train_pi_iters
+        for _ in range(n_iters):
+            # Before doing any computation, always call.zero_grad on the relevant optimizer
+            self.pi_optimizer.zero_grad(set_to_none=True)
+
+            # log pi(a|s) as a single fused log-softmax + gather, without building a distribution
+            logits = self.ac.pi.logits_net(obs)
+            log_pb = -F.cross_entropy(logits, act.long(), reduction='none')
+            if self.clip_ratio is None:
+                g = phi*log_pb
+            else:
+                # the policy has moved too far from the one that collected the data
+                if (logp_old - log_pb).mean().item() > 1.5 * self.target_kl:
+                    break
+                ratio = torch.exp(log_pb - logp_old)
+                clipped = torch.clamp(ratio, 1 - self.clip_ratio, 1 + self.clip_ratio)
+                g = torch.min(ratio*phi, clipped*phi)
+            loss = -g.mean()
 
-        loss.backward()
-        self.pi_optimizer.step()
+            loss.backward()
+            self.pi_optimizer.step()
         return
 
     def v_update(self, data):
@@ -254,13 +429,16 @@ class Agent:
         # In each update, compute a loss for the value function, call loss.backwards() and 
         # then v_optimizer.step()
         # Before doing any computation, always call.zero_grad on the relevant optimizer
-        self.v_optimizer.zero_grad()
-        for _ in range(100):
-            fwd = self.ac.v.forward(obs)
-            loss_nn = nn.MSELoss()
-            loss = loss_nn(fwd, ret-phi)
-            loss.backward()
-            self.v_optimizer.step()
+        # Rather than 100 full-batch steps, make self.v_epochs shuffled passes in minibatches
+        # of self.v_batch_size: far fewer Python and autograd round-trips per epoch.
+        target = (ret - phi).detach()
+        for _ in range(self.v_epochs):
+            for idx in torch.randperm(obs.shape[0], device=obs.device).split(self.v_batch_size):
+                self.v_optimizer.zero_grad(set_to_none=True)
+                pred = self.ac.v(obs[idx])
+                loss = F.mse_loss(pred, target[idx])
+                loss.backward()
+                self.v_optimizer.step()
         return
 
     def train(self):
@@ -288,62 +466,104 @@ class Agent:
         gamma = 0.99
         lam = 0.97
 
+        # Number of sub-environments stepped in parallel; each fills
+        # steps_per_epoch // num_envs steps of the buffer per epoch. Rows that fill early
+        # keep stepping (without storing) until the last row is full.
+        num_envs = 15
+        assert steps_per_epoch % num_envs == 0, "num_envs must divide steps_per_epoch"
+
         # Set up buffer
-        buf = VPGBuffer(obs_dim, act_dim, steps_per_epoch, gamma, lam)
+        buf = VPGBuffer(obs_dim, act_dim, num_envs, steps_per_epoch // num_envs, gamma, lam,
+                        device=self.device)
 
         # Initialize the ADAM optimizer using the parameters
         # of the policy and then value networks
 
-        # Initialize the environment
-        state, ep_ret, ep_len = self.env.reset()[0], 0, 0
-
-        # Main training loop: collect experience in env and update / log each epoch
-        for epoch in range(epochs):
-            ep_returns = []
-            for t in range(steps_per_epoch):
-                a, v, logp = self.ac.step(torch.as_tensor(state, dtype=torch.float32))
-
-                next_state, reward, terminal, truncated, info = self.env.step(a)
-                ep_ret += reward
-                ep_len += 1
-
-                # Log transition
-                buf.store(state, a, reward, v, logp)
-
-                # Update state (critical!)
-                state = next_state
-
-                timeout = ep_len == max_ep_len
-                epoch_ended = (t == steps_per_epoch - 1)
-
-                if terminal or timeout or epoch_ended:
-                    # if trajectory didn't reach terminal state, bootstrap value target
-                    if epoch_ended:
-                        _, v, _ = self.ac.step(torch.as_tensor(state, dtype=torch.float32))
-                    else:
-                        v = 0
-                    if timeout or terminal:
-                        ep_returns.append(ep_ret)  # only store return when episode ended
-                    buf.end_traj(v)
-                    state, ep_ret, ep_len = self.env.reset()[0], 0, 0
-
-            mean_return = np.mean(ep_returns) if len(ep_returns) > 0 else np.nan
-            if len(ep_returns) == 0:
-                print(f"Epoch: {epoch + 1}/{epochs}, all episodes exceeded max_ep_len")
-            print(f"Epoch: {epoch + 1}/{epochs}, mean return {mean_return}")
-
-            # This is the end of an epoch, so here is where we update the policy and value function
-
-            data = buf.get()
-
-            self.pi_update(data)
-            self.v_update(data)
-
+        # Initialize the environments. They truncate episodes at max_ep_len themselves
+        # and reset automatically on the step after an episode has ended (NEXT_STEP);
+        # the autoreset mask below relies on that mode.
+        envs = gym.vector.AsyncVectorEnv(
+            [lambda: gym.make("LunarLander-v3", max_episode_steps=max_ep_len)
+             for _ in range(num_envs)],
+            autoreset_mode=gym.vector.AutoresetMode.NEXT_STEP)
+        try:
+            state, ep_ret = envs.reset()[0], np.zeros(num_envs)
+            # sub-environments whose next step is the automatic reset, not a real transition
+            autoreset = np.zeros(num_envs, dtype=bool)
+
+            # The batched observations are float32 already, so torch.from_numpy aliases them
+            # without a copy. On GPU they are staged through pinned host memory so the
+            # host-to-device copy is asynchronous. The event records when that copy has read
+            # obs_host; the bootstrap copy is not followed by any host sync, so wait on it
+            # before obs_host is overwritten.
+            on_gpu = self.device.type == "cuda"
+            obs_host = torch.empty((num_envs, *obs_dim), pin_memory=on_gpu)
+            obs_dev = torch.empty((num_envs, *obs_dim), device=self.device)
+            obs_copied = torch.cuda.Event() if on_gpu else None
+
+            def to_device(state):
+                if not on_gpu:
+                    return torch.from_numpy(state)
+                obs_copied.synchronize()
+                obs_host.copy_(torch.from_numpy(state))
+                obs_dev.copy_(obs_host, non_blocking=True)
+                obs_copied.record()
+                return obs_dev
+
+            # Pay the compilation cost for the rollout batch shape up front
+            self.ac.step(to_device(state))
+
+            # Main training loop: collect experience in env and update / log each epoch
+            for epoch in range(epochs):
+                ep_returns = []
+                while buf.has_room().any():
+                    obs = to_device(state)
+                    a, v, logp = self.ac.step(obs)
+
+                    next_state, reward, terminal, truncated, info = envs.step(a.cpu().numpy())
+                    active = ~autoreset
+                    ep_ret[active] += reward[active]
+
+                    # Log transitions of the sub-environments with room left this epoch
+                    live = active & buf.has_room()
+                    buf.store(obs, a, reward, v, logp, live)
+
+                    # Update state (critical!)
+                    state = next_state
+
+                    # truncated is the max_ep_len timeout
+                    done = terminal | truncated
+                    epoch_ended = live & ~buf.has_room() & ~done
+
+                    if epoch_ended.any():
+                        # if trajectory didn't reach terminal state, bootstrap value target
+                        _, v, _ = self.ac.step(to_device(state))
+                    for i in np.flatnonzero(live & (done | epoch_ended)):
+                        buf.end_traj(i, v[i] if epoch_ended[i] else 0)
+
+                    ep_returns.extend(ep_ret[done])  # only store return when episode ended
+                    ep_ret[done] = 0
+                    autoreset = done
+
+                mean_return = np.mean(ep_returns) if len(ep_returns) > 0 else np.nan
+                if len(ep_returns) == 0:
+                    print(f"Epoch: {epoch + 1}/{epochs}, all episodes exceeded max_ep_len")
+                print(f"Epoch: {epoch + 1}/{epochs}, mean return {mean_return}")
+
+                # This is the end of an epoch, so here is where we update the policy and value function
+
+                data = buf.get()
+
+                self.pi_update(data)
+                self.v_update(data)
+        finally:
+            # shut down the worker processes even if training is interrupted
+            envs.close()
         return True
 
     def get_action(self, obs):
         """
-        Sample an action from your policy.
+        Return the greedy (most likely) action of your policy for a single observation.
 
         IMPORTANT: This function is called by the checker to evaluate your agent.
         You SHOULD NOT change the arguments this function takes and what it outputs!
@@ -352,7 +572,17 @@ class Agent:
         """
 
 
-        return self.ac.step(torch.FloatTensor(obs))[0]
+        return self.act_only(obs)
+
+    def act_only(self, obs_np):
+        """
+        Greedy action for a single observation, skipping the value and log-probability
+        computation that .step does for training.
+        """
+        with torch.inference_mode():
+            x = torch.from_numpy(np.ascontiguousarray(obs_np, dtype=np.float32)).to(self.device)
+            logits = self.ac.pi.logits_net(x)
+            return int(torch.argmax(logits))
 
 
 def main():